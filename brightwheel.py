@@ -1,15 +1,45 @@
 """This script contains functions that process BrightWheel provider data"""
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
+from concurrent.futures import ThreadPoolExecutor
 import csv
+import orjson
+import os
 import pandas as pd
 import requests
-import warnings
+from requests.adapters import HTTPAdapter
+import shutil
+import time
+from typing import Optional
+import urllib3
 
+# Suppress unverified HTTPS request warnings once for the whole module
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
-def get_provider_data_from_api(api_file_name: str):
+
+def is_file_fresh(file_name: str, max_age_seconds: Optional[float] = None) -> bool:
+    """Checks whether a file exists and was modified within a given age.
+    Args:
+        file_name (str): file name to check
+        max_age_seconds (float): maximum age in seconds, or None to never
+            treat the file as fresh
+    Returns:
+        bool: True if the file can be reused
+    """
+    if max_age_seconds is None or not os.path.exists(file_name):
+        return False
+    return time.time() - os.path.getmtime(file_name) < max_age_seconds
+
+
+def get_provider_data_from_api(
+    api_file_name: str, max_age_seconds: Optional[float] = None
+) -> pd.DataFrame:
     """Gets provider data from API and writes it to a delimited file.
     Args:
         api_file_name (str): file name to store output in
+        max_age_seconds (float): reuse the existing output file instead of
+            calling the API if it is newer than this many seconds
+    Returns:
+        pd.DataFrame: provider rows that were written to the file
     """
     # Source metadata
     URL = "https://bw-interviews.herokuapp.com/data/providers"
@@ -20,37 +50,75 @@ def get_provider_data_from_api(api_file_name: str):
         "email",
         "owner_name",
     ]
+    string_dtypes = {
+        "provider_name": "string[pyarrow]",
+        "phone": "string[pyarrow]",
+        "email": "string[pyarrow]",
+        "owner_name": "string[pyarrow]",
+    }
 
-    # Suppress request warnings
-    warnings.filterwarnings("ignore", message="Unverified HTTPS request")
-
-    # Open output file and write header row
-    output_file = open(api_file_name, "w")
-    csv_file = csv.writer(output_file)
-    csv_file.writerow(header_list)
+    # Reuse the previous output file if it is recent enough, treating only
+    # empty values as missing so it matches a freshly fetched frame
+    if is_file_fresh(api_file_name, max_age_seconds):
+        return pd.read_csv(
+            api_file_name, dtype=string_dtypes, keep_default_na=False, na_values=[""]
+        )
 
     # Call API for specified request
     response = requests.get(URL, verify=False)
 
-    # Parse JSON results out into a delimited file
-    provider_results = response.json()["providers"]
-    for row in provider_results:
-        csv_row = [
+    # Parse JSON results out into provider rows
+    provider_results = orjson.loads(response.content)["providers"]
+    provider_rows = [
+        (
             row["id"],
             row["provider_name"],
             row["phone"],
             row["email"],
             row["owner_name"],
-        ]
-        csv_file.writerow(csv_row)
+        )
+        for row in provider_results
+    ]
+
+    # Write header and provider rows to a csv file
+    with open(api_file_name, "w", buffering=1 << 20, newline="") as output_file:
+        csv_file = csv.writer(output_file)
+        csv_file.writerow(header_list)
+        csv_file.writerows(provider_rows)
+
+    # Treat empty values as missing, as reading the csv file back would
+    return (
+        pd.DataFrame(provider_rows, columns=header_list)
+        .astype(string_dtypes)
+        .replace("", pd.NA)
+    )
 
-    output_file.close()
 
+def get_provider_cells_from_page(session: requests.Session, page_url: str) -> list:
+    """Gets one page of the provider web site and extracts its table cells.
+    Args:
+        session (requests.Session): session to issue the request with
+        page_url (str): URL of the page to fetch
+    Returns:
+        list: text of each <td> in the page's provider table
+    """
+    page_req = session.get(page_url, verify=False)
 
-def get_provider_data_from_web_site(web_file_name: str):
+    # Parse only the HTML table, extracting providers from it
+    soup = BeautifulSoup(page_req.content, "lxml", parse_only=SoupStrainer("table"))
+    return [element.text for element in soup.find("table").find_all("td")]
+
+
+def get_provider_data_from_web_site(
+    web_file_name: str, max_age_seconds: Optional[float] = None
+) -> pd.DataFrame:
     """Gets provider data from a web site and writes it to a delimited file.
     Args:
         web_file_name (str): file name to store output in
+        max_age_seconds (float): reuse the existing output file instead of
+            scraping the web site if it is newer than this many seconds
+    Returns:
+        pd.DataFrame: provider rows that were written to the file
     """
     # Source metadata
     URL = "http://naccrrapps.naccrra.org/navy/directory/programs.php?program=omcc&state=CA&pagenum="
@@ -65,34 +133,46 @@ def get_provider_data_from_web_site(web_file_name: str):
         "email",
     ]
 
-    # Suppress request warnings
-    warnings.filterwarnings("ignore", message="Unverified HTTPS request")
-
-    # Open output file and write header row
-    output_file = open(web_file_name, "w")
-    csv_file = csv.writer(output_file)
-    csv_file.writerow(header_list)
+    # Reuse the previous output file if it is recent enough, treating only
+    # empty cells as missing so it matches a freshly scraped frame
+    if is_file_fresh(web_file_name, max_age_seconds):
+        return pd.read_csv(
+            web_file_name,
+            dtype="string[pyarrow]",
+            keep_default_na=False,
+            na_values=[""],
+        )
 
-    # Get 45 pages of data from web site
-    for page in range(1, 45):
-        page_req = requests.get(URL + str(page), verify=False)
+    # Get and parse 45 pages of data from web site, reusing pooled connections
+    with requests.Session() as session:
+        session.mount("http://", HTTPAdapter(pool_connections=8, pool_maxsize=16))
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            pages = list(
+                executor.map(
+                    lambda page: get_provider_cells_from_page(
+                        session, URL + str(page)
+                    ),
+                    range(1, 45),
+                )
+            )
 
-        # Parse HTML, extracting providers from an HTML table
-        soup = BeautifulSoup(page_req.content, "html.parser")
-        html_table = soup.find("table").find_all("td")
-        column_num = 1
-        row = []
+    # Split each page's cells into rows of 8 columns, dropping any partial row
+    provider_rows = [
+        row
+        for page_cells in pages
+        for row in zip(*[iter(page_cells)] * len(header_list))
+    ]
 
-        # Write 8 columns per row to a csv file
-        for element in html_table:
-            row.append(element.text)
-            if column_num == 8:
-                csv_file.writerow(row)
-                row = []
-                column_num = 0
-            column_num += 1
+    # Write header and provider rows to a csv file
+    with open(web_file_name, "w", buffering=1 << 20, newline="") as output_file:
+        csv_file = csv.writer(output_file)
+        csv_file.writerow(header_list)
+        csv_file.writerows(provider_rows)
 
-    output_file.close()
+    # Treat empty cells as missing, as reading the csv file back would
+    return pd.DataFrame(
+        provider_rows, columns=header_list, dtype="string[pyarrow]"
+    ).replace("", pd.NA)
 
 
 def add_header_to_file(input_file_name: str, output_file_name: str, header_list: list):
@@ -100,20 +180,27 @@ def add_header_to_file(input_file_name: str, output_file_name: str, header_list:
     Args:
         input_file_name (str): file name to read from
         output_file_name (str): file name to write to
+        header_list (list): column names to write as the header row
     """
-    # Read file and add a header row
-    df = pd.read_csv(input_file_name)
-    df.to_csv(output_file_name, header=header_list, index=False)
+    # Write the header row, then copy the file's bytes through unparsed
+    with open(output_file_name, "wb") as output_file:
+        output_file.write((",".join(header_list) + "\n").encode())
+        with open(input_file_name, "rb") as input_file:
+            shutil.copyfileobj(input_file, output_file, length=1 << 20)
 
 
-def merge_provider_files():
-    """Merges 3 BrightWheel provider sources into 1 output csv file"""
+def merge_provider_files(max_age_seconds: Optional[float] = None):
+    """Merges 3 BrightWheel provider sources into 1 output csv file
+    Args:
+        max_age_seconds (float): reuse API and web site output files newer
+            than this many seconds instead of fetching them again
+    """
 
     # Pull provider data from API and web site, storing in csv files
     api_file_name = "providers_from_api.csv"
-    get_provider_data_from_api(api_file_name)
+    df_api = get_provider_data_from_api(api_file_name, max_age_seconds)
     web_file_name = "providers_from_web.csv"
-    get_provider_data_from_web_site(web_file_name)
+    df_web = get_provider_data_from_web_site(web_file_name, max_age_seconds)
 
     # Add header row to attached file
     attached_file_name = "x_ca_omcc_providers.csv"
@@ -129,65 +216,51 @@ def merge_provider_files():
     ]
     add_header_to_file(attached_file_name, attached_file_name_with_header, header_list)
 
-    # Read 3 source files into dataframes
-    df_api = pd.read_csv(api_file_name)
-    df_web = pd.read_csv(web_file_name)
-    df_attached = pd.read_csv(attached_file_name_with_header)
+    # Read attached file into a dataframe
+    df_attached = pd.read_csv(attached_file_name_with_header, dtype="string[pyarrow]")
 
     # Clean up attached file
-    df_attached = df_attached.drop_duplicates()
-    df_attached["address"] = df_attached["address"].apply(str)
-    df_attached["phone"] = df_attached["phone"].apply(str)
-    df_attached["phone"] = (
-        "("
-        + df_attached["phone"].str[:3]
-        + ") "
-        + df_attached["phone"].str[3:6]
-        + "-"
-        + df_attached["phone"].str[6:]
+    df_attached["address"] = df_attached["address"].fillna("")
+    df_attached["phone"] = df_attached["phone"].str.replace(
+        r"^(\d{3})(\d{3})(\d+)$", r"(\1) \2-\3", regex=True
     )
-    df_attached["address"] = df_attached["address"].str.replace("nan", "")
-    df_attached["dupe_count"] = df_attached.groupby(["provider_name", "phone"])[
-        "provider_name"
-    ].transform("count")
     df_attached = df_attached.sort_values(by=["provider_name", "phone"])
+    df_attached["dupe_count"] = df_attached.groupby(
+        ["provider_name", "phone"], sort=False
+    )["provider_name"].transform("size")
+    df_attached = df_attached.drop_duplicates(
+        ["provider_name", "phone"], keep="first", ignore_index=True
+    )
     df_attached.to_csv(attached_file_name_with_header, index=False)
 
-    # Merge api and web dataframes
-    df_merged = pd.merge(
-        df_api,
-        df_web[
-            [
-                "provider_name",
-                "phone",
-                "type_of_care",
-                "address",
-                "city",
-                "state",
-                "zip",
-            ]
-        ],
-        on=["provider_name", "phone"],
-        how="left",
-    )
+    merge_keys = ["provider_name", "phone"]
+    fill_columns = ["type_of_care", "address", "city", "state", "zip"]
+    df_merged = df_api.set_index(merge_keys)
+
+    # Look up web columns for each api row by provider name and phone
+    df_web_indexed = df_web.drop_duplicates(merge_keys).set_index(merge_keys)
+    for column in fill_columns:
+        df_merged[column + "_x"] = df_merged.index.map(
+            df_web_indexed[column]
+        ).to_numpy()
 
-    # Merge attached dataframe
-    df_merged = pd.merge(
-        df_merged,
-        df_attached,
-        on=["provider_name", "phone"],
-        how="left",
+    # Join attached dataframe, failing rather than fanning out api rows
+    df_attached_indexed = df_attached.set_index(merge_keys).rename(
+        columns={column: column + "_y" for column in fill_columns}
     )
+    df_merged = df_merged.join(
+        df_attached_indexed, how="left", validate="m:1"
+    ).reset_index()
+    df_merged = df_merged[
+        list(df_api.columns)
+        + list(df_merged.columns.difference(df_api.columns, sort=False))
+    ]
 
     # Use whichever column has a non-null value
-    df_merged.loc[df_merged["type_of_care_x"].isnull(), "type_of_care_x"] = df_merged[
-        "type_of_care_y"
-    ]
-    df_merged.loc[df_merged["address_x"].isnull(), "address_x"] = df_merged["address_y"]
-    df_merged.loc[df_merged["city_x"].isnull(), "city_x"] = df_merged["city_y"]
-    df_merged.loc[df_merged["state_x"].isnull(), "state_x"] = df_merged["state_y"]
-    df_merged.loc[df_merged["zip_x"].isnull(), "zip_x"] = df_merged["zip_y"]
-    df_merged["address_x"] = df_merged["address_x"].str.replace("nan", "")
+    for column in fill_columns:
+        df_merged[column + "_x"] = df_merged[column + "_x"].fillna(
+            df_merged[column + "_y"]
+        )
 
     # Drop extraneous columns and rename 'x' columns
     df_merged = df_merged.drop(